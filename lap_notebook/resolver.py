@@ -1,58 +1,302 @@
 from __future__ import annotations
+import functools
+import hashlib
+import logging
+import mmap
 import os
+import pickle
 import re
+import sys
+import tempfile
+import threading
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Set, Tuple
-
-CFG_VAR_RE = re.compile(r"^\s*([A-Za-z_]\w*)\s*=\s*(.*?)\s*$")
-CFG_CLASS_RE = re.compile(r"^\s*class\s+([A-Za-z_]\w*)\s*=\s*(.+?)(?:\s+parent\s+([A-Za-z_]\w*))?\s*$")
-CFG_DIR_RE = re.compile(r"""^\s*(?:\w+\s+)*mkdir\s+path\s+([A-Za-z_]\w*)\s*=\s*(\S+)(?:.*?\bclass_level\s+([A-Za-z_]\w*))?.*$""", re.X)
-CFG_FILE_RE = re.compile(r"""^\s*(?:\w+\s+)*path\s+file\s+([A-Za-z_]\w*)\s*=\s*(\S+)\s+dir\s+([A-Za-z_]\w*)(?:.*?\bclass_level\s+([A-Za-z_]\w*))?.*$""", re.X)
-DOLLAR_RE = re.compile(r"\$([A-Za-z_]\w*)")
-AT_RE = re.compile(r"@([A-Za-z_]\w*)")
-
-META_KEY_RE = re.compile(r"^\s*!key\s+([A-Za-z_]\w*)\s+(.*?)\s*$")
-META_CONFIG_RE = re.compile(r"^\s*!config\s+(\S+)\s*$")
-META_CLASS_RE = re.compile(r"^\s*([^\s#]+)\s+class\s+([A-Za-z_]\w*)\s*$")
-META_PARENT_RE = re.compile(r"^\s*([^\s#]+)\s+parent\s+([^\s#]+)\s*$")
-META_PROP_RE = re.compile(r"^\s*([^\s#]+)\s+([A-Za-z_]\w*)\s+(.*?)\s*$")
+from typing import BinaryIO, Deque, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the pickled LapResolver layout, or the parsing that fills it, changes
+PIPELINE_CACHE_VERSION = "9"
+
+# dataclass(slots=True) needs Python 3.10+; plain dataclasses on 3.9
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# Value side of "mkdir path <name>=..." and "path file <name>=..." lines, matched in one go
+_CLASS_LEVEL = r"(?:.*?\bclass_level\s+(?P<lvl>[A-Za-z_]\w*))?"
+DIR_VALUE_RE = re.compile(r"\s*(?P<tpl>\S+)" + _CLASS_LEVEL)
+FILE_VALUE_RE = re.compile(r"\s*(?P<tpl>\S+)\s+dir\s+(?P<dir>[A-Za-z_]\w*)" + _CLASS_LEVEL)
+PLACEHOLDER_RE = re.compile(r"[@$][A-Za-z_]\w*")
+
+# A template is kept as a tuple of segments: ("lit", text), ("$", var name) or ("@", "@placeholder")
+Segments = Tuple[Tuple[str, str], ...]
+
+def _decode_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decodes "\\n"-terminated chunks, splitting on "\\r\\n" and lone "\\r" like text-mode universal newlines."""
+    for raw in chunks:
+        if b"\r" not in raw:
+            yield raw.decode("utf-8", "ignore")
+            continue
+        pieces = raw.decode("utf-8", "ignore").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        for piece in pieces[:-1]:
+            yield piece + "\n"
+        if pieces[-1]:
+            yield pieces[-1]
+
+def _iter_lines(f: BinaryIO) -> Iterator[str]:
+    """Yields the decoded lines of a file opened in binary mode, reading it through mmap."""
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # empty file or not mappable (pipe, special file)
+        yield from _decode_lines(f)
+        return
+    with mm:
+        yield from _decode_lines(iter(mm.readline, b""))
 
 def _strip_comments(line: str) -> str:
     if "#" in line:
         return line.split("#", 1)[0]
     return line
 
-def _expand_dollars(s: str, varmap: Dict[str, str]) -> str:
-    def repl(m: re.Match) -> str:
-        key = m.group(1)
-        return varmap.get(key, m.group(0))
-    return DOLLAR_RE.sub(repl, s)
-
+def _segments(s: str) -> Segments:
+    if "$" not in s and "@" not in s:
+        return (("lit", s),) if s else ()
+    segs: List[Tuple[str, str]] = []
+    pos = 0
+    for m in PLACEHOLDER_RE.finditer(s):
+        start = m.start()
+        if start > pos:
+            segs.append(("lit", s[pos:start]))
+        if s[start] == "$":
+            segs.append(("$", s[start + 1:m.end()]))
+        else:
+            segs.append(("@", m.group()))
+        pos = m.end()
+    if pos < len(s):
+        segs.append(("lit", s[pos:]))
+    return tuple(segs)
+
+# $var values carrying @placeholders are re-split on every render; there are only a few of them
+_var_segments = functools.lru_cache(maxsize=1024)(_segments)
+
+def _render(segs: Segments, varmap: Dict[str, str], ph: Optional[Dict[str, str]] = None) -> Optional[str]:
+    """
+    Joins template segments, substituting $vars from varmap (unknown ones are kept as-is)
+    and @placeholders from ph. @placeholders are left untouched when ph is None, otherwise
+    an unresolved one makes the whole expansion fail with None.
+    """
+    if len(segs) == 1 and segs[0][0] == "lit":
+        return segs[0][1]
+    out: List[str] = []
+    for kind, val in segs:
+        if kind == "lit":
+            out.append(val)
+        elif kind == "$":
+            sub = varmap.get(val)
+            if sub is None:
+                out.append("$" + val)
+                continue
+            if ph is not None and "@" in sub:
+                # $var values may themselves carry @placeholders (e.g. class_level dirs)
+                sub = _render(_var_segments(sub), {}, ph)
+                if sub is None:
+                    return None
+            out.append(sub)
+        elif ph is None:
+            out.append(val)
+        else:
+            sub = ph.get(val)
+            if sub is None:
+                return None
+            out.append(sub)
+    return "".join(out)
+
+@functools.lru_cache(maxsize=1024)
+def _norm_key(k: str) -> str:
+    return k if k.startswith("@") else "@" + k
+
+@functools.lru_cache(maxsize=4096)
 def _norm_join(*parts: str) -> str:
     return os.path.normpath(os.path.join(*parts))
 
-@dataclass
+def _join_leaf(dir_path: str, leaf: str) -> str:
+    """_norm_join for an already normalized dir_path; leaves that normpath would not change are just appended."""
+    if (not leaf or leaf[0] == os.sep or leaf[-1] in (os.sep, ".")
+            or os.sep * 2 in leaf or ".." in leaf or "." + os.sep in leaf
+            or (os.altsep and (os.altsep in leaf or ":" in leaf))):
+        # on Windows join/normpath also handle "/" and drive letters, so such leaves take the slow path
+        return _norm_join(dir_path, leaf)
+    if dir_path.endswith(os.sep):
+        return dir_path + leaf
+    return dir_path + os.sep + leaf
+
+def _components(nodes: List[str], edges: Dict[str, Iterable[str]]) -> List[List[str]]:
+    """
+    Strongly connected components of the graph restricted to nodes (iterative Tarjan). Each
+    component comes after every component it has edges into; members keep their order in nodes.
+    """
+    rank = {n: i for i, n in enumerate(nodes)}
+    order: Dict[str, int] = {}
+    low: Dict[str, int] = {}
+    path: List[str] = []
+    on_path: Set[str] = set()
+    comps: List[List[str]] = []
+    for root in nodes:
+        if root in order:
+            continue
+        order[root] = low[root] = len(order)
+        path.append(root)
+        on_path.add(root)
+        work: List[Tuple[str, Iterator[str]]] = [(root, iter(edges.get(root, ())))]
+        while work:
+            node, targets = work[-1]
+            for t in targets:
+                if t not in rank:
+                    continue
+                if t not in order:
+                    order[t] = low[t] = len(order)
+                    path.append(t)
+                    on_path.add(t)
+                    work.append((t, iter(edges.get(t, ()))))
+                    break
+                if t in on_path:
+                    low[node] = min(low[node], order[t])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                if low[node] == order[node]:
+                    comp: List[str] = []
+                    while True:
+                        m = path.pop()
+                        on_path.discard(m)
+                        comp.append(m)
+                        if m == node:
+                            break
+                    comps.append(sorted(comp, key=rank.__getitem__))
+    return comps
+
+def _cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "lap_notebook")
+
+def _load_cached(path: str) -> Optional[Tuple[str, "LapResolver"]]:
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # missing, truncated or written by an incompatible version: rebuild
+        return None
+
+def _write_cached(path: str, payload: Tuple[str, "LapResolver"]) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # named like the entries so clear_cache() also sweeps files left by an interrupted write
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix="resolver-", suffix=".pkl.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+
+@dataclass(**_SLOTS)
 class ClassDef:
     name: str
     display: str
     parent: Optional[str] = None
 
-@dataclass
+@dataclass(**_SLOTS)
 class DirTemplate:
     name: str
     template: str
     class_level: Optional[str] = None
+    segments: Segments = field(init=False, repr=False, compare=False)
+    def __post_init__(self) -> None:
+        self.segments = _segments(self.template)
     def tokens(self) -> Set[str]:
-        return set(AT_RE.findall(self.template))
+        return {v[1:] for k, v in self.segments if k == "@"}
 
-@dataclass
+@dataclass(**_SLOTS)
 class FileTemplate:
     name: str
     tpl: str
     dir_ref: str
     class_level: Optional[str] = None
+    segments: Segments = field(init=False, repr=False, compare=False)
+    def __post_init__(self) -> None:
+        self.segments = _segments(self.tpl)
     def tokens(self) -> Set[str]:
-        return set(AT_RE.findall(self.tpl))
+        return {v[1:] for k, v in self.segments if k == "@"}
+
+# Line extractors. Each takes the text following its keyword token and returns
+# the parsed entry, or None if the line does not fit the rule.
+
+def _split_first(s: str) -> Tuple[str, str]:
+    parts = s.split(None, 1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return (parts[0] if parts else ""), ""
+
+def _is_word(tok: str) -> bool:
+    return tok.replace("_", "a").isalnum()
+
+def _split_assign(rest: str) -> Optional[Tuple[str, str]]:
+    name, sep, value = rest.partition("=")
+    name = name.strip()
+    if not sep or not name.isidentifier():
+        return None
+    return name, value
+
+def _parse_class(rest: str) -> Optional[ClassDef]:
+    assign = _split_assign(rest)
+    if not assign:
+        return None
+    name, disp = assign
+    disp = disp.strip()
+    if not disp:
+        return None
+    parent = None
+    parts = disp.rsplit(None, 2)
+    if len(parts) == 3 and parts[1] == "parent" and parts[2].isidentifier():
+        disp, parent = parts[0], parts[2]
+    return ClassDef(name, disp, parent)
+
+def _parse_mkdir(rest: str) -> Optional[DirTemplate]:
+    kw, rest = _split_first(rest)
+    if kw != "path":
+        return None
+    assign = _split_assign(rest)
+    if not assign:
+        return None
+    name, value = assign
+    m = DIR_VALUE_RE.match(value)
+    if not m:
+        return None
+    return DirTemplate(name, m.group("tpl"), m.group("lvl"))
+
+def _parse_path(rest: str) -> Optional[FileTemplate]:
+    kw, rest = _split_first(rest)
+    if kw != "file":
+        return None
+    assign = _split_assign(rest)
+    if not assign:
+        return None
+    name, value = assign
+    m = FILE_VALUE_RE.match(value)
+    if not m:
+        return None
+    return FileTemplate(name, m.group("tpl"), m.group("dir"), m.group("lvl"))
+
+# keyword -> (extractor, PipelineCfg field the entry is stored in)
+_CFG_DISPATCH = {
+    "class": (_parse_class, "classes"),
+    "mkdir": (_parse_mkdir, "dirs"),
+    "path": (_parse_path, "files"),
+}
 
 @dataclass
 class PipelineCfg:
@@ -63,7 +307,7 @@ class PipelineCfg:
     files: Dict[str, FileTemplate] = field(default_factory=dict) # file key -> template
 
     @classmethod
-    def parse(cls, text: str, extra_vars: Optional[Dict[str, str]] = None) -> "PipelineCfg":
+    def parse(cls, text: Union[str, Iterable[str]], extra_vars: Optional[Dict[str, str]] = None) -> "PipelineCfg":
         variables: Dict[str, str] = {}
         classes: Dict[str, ClassDef] = {}
         dirs: Dict[str, DirTemplate] = {}
@@ -72,33 +316,33 @@ class PipelineCfg:
         if extra_vars:
             variables.update(extra_vars)
 
-        for raw in text.splitlines():
+        tables = {"classes": classes, "dirs": dirs, "files": files}
+        for raw in (text.splitlines() if isinstance(text, str) else text):
             line = _strip_comments(raw).strip()
             if not line:
                 continue
 
-            m = CFG_VAR_RE.match(line)
-            if m:
-                variables[m.group(1)] = m.group(2)
+            head, sep, value = line.partition("=")
+            head = head.rstrip()
+            if sep and head.isidentifier():
+                variables[head] = value.strip()
                 continue
 
-            m = CFG_CLASS_RE.match(line)
-            if m:
-                name, disp, parent = m.group(1), m.group(2).strip(), m.group(3)
-                classes[name] = ClassDef(name, disp, parent)
-                continue
-
-            m = CFG_DIR_RE.match(line)
-            if m:
-                name, tpl, lvl = m.group(1), m.group(2), m.group(3)
-                dirs[name] = DirTemplate(name, tpl, lvl)
-                continue
-
-            m = CFG_FILE_RE.match(line)
-            if m:
-                name, tpl, dir_ref, lvl = m.group(1), m.group(2), m.group(3), m.group(4)
-                files[name] = FileTemplate(name, tpl, dir_ref, lvl)
-                continue
+            # mkdir/path lines may carry leading modifier words ("local mkdir path ..."),
+            # a class definition must start the line
+            tok, rest = _split_first(line)
+            leading = True
+            while tok:
+                rule = _CFG_DISPATCH.get(tok)
+                if rule and (leading or tok != "class"):
+                    entry = rule[0](rest)
+                    if entry is not None:
+                        tables[rule[1]][entry.name] = entry
+                        break
+                if not _is_word(tok):
+                    break
+                tok, rest = _split_first(rest)
+                leading = False
 
         child_classes: Dict[str, List[str]] = {}
         for c in classes.values():
@@ -109,10 +353,10 @@ class PipelineCfg:
 
     @classmethod
     def from_file(cls, path: str, extra_vars: Optional[Dict[str, str]] = None) -> "PipelineCfg":
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return cls.parse(f.read(), extra_vars=extra_vars)
+        with open(path, "rb") as f:
+            return cls.parse(_iter_lines(f), extra_vars=extra_vars)
 
-@dataclass
+@dataclass(**_SLOTS)
 class Instance:
     name: str
     class_name: str
@@ -127,49 +371,50 @@ class Meta:
     by_class: Dict[str, List[str]] = field(default_factory=dict) # class -> [instance names]
 
     @classmethod
-    def parse(cls, text: str) -> "Meta":
+    def parse(cls, text: Union[str, Iterable[str]]) -> "Meta":
         keys: Dict[str, str] = {}
         config_path: Optional[str] = None
         instances: Dict[str, Instance] = {}
 
-        for raw in text.splitlines():
+        for raw in (text.splitlines() if isinstance(text, str) else text):
             line = _strip_comments(raw).strip()
             if not line:
                 continue
 
-            m = META_CONFIG_RE.match(line)
-            if m:
-                config_path = m.group(1)
-                continue
-
-            m = META_KEY_RE.match(line)
-            if m:
-                keys[m.group(1)] = m.group(2)
-                continue
+            tok, rest = _split_first(line)
+            if tok == "!config":
+                path, extra = _split_first(rest)
+                if path and not extra:
+                    config_path = path
+                    continue
+            elif tok == "!key":
+                name, val = _split_first(rest)
+                if val and name.isidentifier():
+                    keys[name] = val
+                    continue
 
-            m = META_CLASS_RE.match(line)
-            if m:
-                inst, clsname = m.group(1), m.group(2)
-                inst_obj = instances.get(inst) or Instance(inst, clsname, [], {})
-                inst_obj.class_name = clsname
-                instances[inst] = inst_obj
+            # "<instance> class <cls>", "<instance> parent <inst>" or "<instance> <prop> <value>"
+            key, val = _split_first(rest)
+            if not val:
                 continue
-
-            m = META_PARENT_RE.match(line)
-            if m:
-                inst, parent_inst = m.group(1), m.group(2)
-                inst_obj = instances.get(inst) or Instance(inst, class_name="", parents=[], props={})
-                inst_obj.parents.append(parent_inst)
-                instances[inst] = inst_obj
+            if key == "class" and val.isidentifier():
+                rule = "class"
+            elif key == "parent" and len(val.split()) == 1:
+                rule = "parent"
+            elif key.isidentifier():
+                rule = "prop"
+            else:
                 continue
 
-            m = META_PROP_RE.match(line)
-            if m:
-                inst, key, val = m.group(1), m.group(2), m.group(3)
-                inst_obj = instances.get(inst) or Instance(inst, class_name="", parents=[], props={})
+            inst_obj = instances.get(tok)
+            if inst_obj is None:
+                inst_obj = instances[tok] = Instance(tok, class_name="", parents=[], props={})
+            if rule == "class":
+                inst_obj.class_name = val
+            elif rule == "parent":
+                inst_obj.parents.append(val)
+            else:
                 inst_obj.props[key] = val
-                instances[inst] = inst_obj
-                continue
 
         by_class: Dict[str, List[str]] = {}
         for inst, obj in instances.items():
@@ -180,15 +425,21 @@ class Meta:
 
     @classmethod
     def from_file(cls, path: str) -> "Meta":
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return cls.parse(f.read())
+        with open(path, "rb") as f:
+            return cls.parse(_iter_lines(f))
+
+# Index buckets, in the order get()/records() list them: meta overrides, then template expansions
+_SOURCES = ("raw", "out")
 
 class LapResolver:
     """
-    Loads CFG + META, builds a full index of absolute file paths.
+    Loads CFG + META, builds an index of absolute file paths. A file key is indexed on its
+    first lookup; use preload() to index keys up front.
     - Index key: cfg file key (e.g., "model_selection_plot_out_file")
-    - Index value: list of dicts with {"path": <abs-path>, "placeholders": {<ph>:<value>}, "class_level": <lvl>, "source": "template|override"}
-    Supports filtering by placeholders.
+    - Index value: {"raw"|"out": list of dicts with {"path": <abs-path>, "placeholders": {<ph>:<value>}, "class_level": <lvl>, "source": "raw|out"}},
+      bucketed by source; raw records are meta overrides, out records template expansions
+      Placeholder dicts are shared between the records of an instance, so treat records() results as read-only.
+    Supports filtering by placeholders, answered from a per-file-key (placeholder, value) -> positions index.
     """
 
     def __init__(self, cfg: PipelineCfg, meta: Meta, cwd: Optional[str] = None):
@@ -201,163 +452,304 @@ class LapResolver:
 
         self.concrete_dirs: Dict[str, str] = {}
         self._bootstrap_concrete_dirs()
+        # fixed from here on; shared by every expansion below
+        self._full_varmap: Dict[str, str] = {**self.varmap, **self.concrete_dirs}
+
+        self._ancestry: Optional[Dict[str, Set[str]]] = None
+        self._ctx_cache: Dict[str, Dict[str, str]] = {}
+        # one shared dict per distinct placeholder mapping
+        self._ctx_pool: Dict[FrozenSet[Tuple[str, str]], Dict[str, str]] = {}
+
+        self.index: Dict[str, Dict[str, List[Dict]]] = {}
+        # file key -> source -> {(placeholder, value): ascending positions in self.index[file key][source]}
+        self.filter_index: Dict[str, Dict[str, Dict[Tuple[str, str], List[int]]]] = {}
+        self._built: Set[str] = set()
+
+    @property
+    def ancestry(self) -> Dict[str, Set[str]]:
+        """instance -> all of its ancestor instances; computed on first access."""
+        if self._ancestry is None:
+            self._ancestry = self._compute_ancestry()
+        return self._ancestry
 
-        self.ancestry: Dict[str, Set[str]] = self._compute_ancestry()
+    @classmethod
+    def from_files(cls, cfg_path: str, meta_path: str, cwd: Optional[str] = None,
+                   extra_vars: Optional[Dict[str, str]] = None,
+                   use_cache: bool = True, allow_stale: bool = False) -> "LapResolver":
+        """
+        Parses cfg_path + meta_path into a fully indexed resolver, reusing the copy pickled
+        under ~/.cache/lap_notebook while neither file's content has changed. With
+        allow_stale=True an outdated copy is returned right away and refreshed in a background thread.
+        """
+        cwd = cwd or os.getcwd()
+        if not use_cache:
+            return cls._build_from_files(cfg_path, meta_path, cwd, extra_vars)
+
+        extra = sorted((extra_vars or {}).items())
+        entry = hashlib.sha256("\0".join(
+            [PIPELINE_CACHE_VERSION, os.path.abspath(cfg_path), os.path.abspath(meta_path), cwd, repr(extra)]
+        ).encode()).hexdigest()
+        cache_path = os.path.join(_cache_dir(), f"resolver-{entry}.pkl")
+
+        h = hashlib.sha256(PIPELINE_CACHE_VERSION.encode())
+        for path in (cfg_path, meta_path):
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        h.update(cwd.encode())
+        h.update(repr(extra).encode())
+        digest = h.hexdigest()
+
+        cached = _load_cached(cache_path)
+        if cached is not None:
+            cached_digest, resolver = cached
+            if cached_digest == digest:
+                return resolver
+            if allow_stale:
+                threading.Thread(
+                    target=cls._refresh_cache,
+                    args=(cfg_path, meta_path, cwd, extra_vars, cache_path, digest),
+                    daemon=True,
+                ).start()
+                return resolver
+        return cls._refresh_cache(cfg_path, meta_path, cwd, extra_vars, cache_path, digest)
 
-        self.index: Dict[str, List[Dict]] = {}
-        self._build_index()
+    @classmethod
+    def _build_from_files(cls, cfg_path: str, meta_path: str, cwd: str,
+                          extra_vars: Optional[Dict[str, str]]) -> "LapResolver":
+        cfg = PipelineCfg.from_file(cfg_path, extra_vars=extra_vars)
+        meta = Meta.from_file(meta_path)
+        return cls(cfg, meta, cwd=cwd)
+
+    @classmethod
+    def _refresh_cache(cls, cfg_path: str, meta_path: str, cwd: str, extra_vars: Optional[Dict[str, str]],
+                       cache_path: str, digest: str) -> "LapResolver":
+        resolver = cls._build_from_files(cfg_path, meta_path, cwd, extra_vars)
+        resolver.preload()
+        _write_cached(cache_path, (digest, resolver))
+        return resolver
+
+    @staticmethod
+    def clear_cache() -> None:
+        """Removes every resolver pickled by from_files(), along with leftover partial writes."""
+        cache_dir = _cache_dir()
+        if not os.path.isdir(cache_dir):
+            return
+        for name in os.listdir(cache_dir):
+            if name.startswith("resolver-") and name.endswith((".pkl", ".pkl.tmp")):
+                try:
+                    os.unlink(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
 
     def _bootstrap_concrete_dirs(self) -> None:
-        changed = True
-        for _ in range(8):
-            if not changed:
-                break
-            changed = False
-            for name, d in self.cfg.dirs.items():
-                if name in self.concrete_dirs:
-                    continue
-                expanded = _expand_dollars(d.template, {**self.varmap, **self.concrete_dirs})
-                if '@' in expanded:
-                    # Just add the variable to the varmap everything before the @
-                    self.varmap[name] = expanded
-                    continue
-                if not os.path.isabs(expanded):
-                    expanded = _norm_join(self.cwd, expanded)
-                self.concrete_dirs[name] = expanded
+        # expand each dir once, after the dirs its $refs point to (Kahn's algorithm)
+        dirs = self.cfg.dirs
+        deps: Dict[str, Set[str]] = {}
+        indegree: Dict[str, int] = {}
+        dependents: Dict[str, List[str]] = {}
+        for name, d in dirs.items():
+            deps[name] = {v for k, v in d.segments if k == "$" and v in dirs and v != name}
+            indegree[name] = len(deps[name])
+            for dep in deps[name]:
+                dependents.setdefault(dep, []).append(name)
+
+        ready: Deque[str] = deque(name for name, n in indegree.items() if n == 0)
+        order: List[str] = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for child in dependents.get(name, ()):
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    ready.append(child)
+        if len(order) < len(dirs):
+            # what's left is reference cycles plus the dirs depending on them: expand component
+            # by component, each after the ones it references, cycle members in cfg order
+            stuck = [name for name, n in indegree.items() if n > 0]
+            cyclic: List[str] = []
+            for comp in _components(stuck, deps):
+                if len(comp) > 1:
+                    cyclic.extend(comp)
+                order.extend(comp)
+            logger.warning("cyclic $ references between mkdir paths %s; expanding cycle members in cfg order", ", ".join(cyclic))
+
+        for name in order:
+            expanded = _render(dirs[name].segments, self.varmap)
+            if '@' in expanded:
+                # Just add the variable to the varmap everything before the @
                 self.varmap[name] = expanded
-                changed = True
+                continue
+            if not os.path.isabs(expanded):
+                expanded = _norm_join(self.cwd, expanded)
+            self.concrete_dirs[name] = expanded
+            self.varmap[name] = expanded
 
     def _compute_ancestry(self) -> Dict[str, Set[str]]:
-        parents = {inst: set(obj.parents) for inst, obj in self.meta.instances.items()}
-        closure: Dict[str, Set[str]] = {inst: set(p) for inst, p in parents.items()}
-        changed = True
-        for _ in range(64):
-            if not changed:
-                break
-            changed = False
-            for inst in list(closure.keys()):
-                new_set = set(closure[inst])
-                for p in list(closure[inst]):
-                    new_set |= closure.get(p, set())
-                if len(new_set) > len(closure[inst]):
-                    closure[inst] = new_set
-                    changed = True
+        # components come ancestors-first, so each one's closure is built once from finished
+        # parent closures; members of a parent cycle share it
+        instances = self.meta.instances
+        closure: Dict[str, Set[str]] = {}
+        for comp in _components(list(instances), {i: obj.parents for i, obj in instances.items()}):
+            ancestors: Set[str] = set()
+            for m in comp:
+                for p in instances[m].parents:
+                    ancestors.add(p)
+                    if p in closure:
+                        ancestors |= closure[p]
+            for m in comp:
+                closure[m] = ancestors
         return closure
 
-    def _ph_needed_for_file(self, f, d) -> Set[str]:
-        toks = set()
-        toks |= f.tokens()
-        toks |= d.tokens()
-        return set('@' + t for t in toks)
-
-    def _expand_placeholders(self, s: str, ph: Dict[str, str]) -> str:
-        s = _expand_dollars(s, {**self.varmap, **self.concrete_dirs})
-        def repl(m: re.Match) -> str:
-            key = '@' + m.group(1)
-            if key in ph:
-                return ph[key]
-            return m.group(0)
-        return AT_RE.sub(repl, s)
-
-    def _resolve_dir(self, d, ph: Dict[str, str]) -> Optional[str]:
-        s = self._expand_placeholders(d.template, ph)
-        if '@' in s:
+    def _resolve_dir(self, segs: Segments, ph: Dict[str, str]) -> Optional[str]:
+        s = _render(segs, self._full_varmap, ph)
+        if s is None:
+            return None
+        # normalized even when absolute, so file names can be appended as-is
+        return _norm_join(self.cwd, s)
+
+    def _expand_file(self, ftemp: FileTemplate, dtemp: DirTemplate, ph: Dict[str, str]) -> Optional[str]:
+        full_dir = self._resolve_dir(dtemp.segments, ph)
+        if full_dir is None:
             return None
-        if not os.path.isabs(s):
-            s = _norm_join(self.cwd, s)
-        return s
-
-    def _contexts_for_class_level(self, class_level: Optional[str]) -> List[Dict[str, str]]:
-        contexts: List[Dict[str, str]] = []
-        if not class_level:
-            return [dict()]
-        inst_names = self.meta.by_class.get(class_level, [])
-        for inst in inst_names:
-            ctx = self._build_context_from_instance(inst)
-            if ctx:
-                contexts.append(ctx)
-        return contexts
+        fname_expanded = _render(ftemp.segments, self._full_varmap, ph)
+        if fname_expanded is None:
+            return None
+        return _join_leaf(full_dir, fname_expanded)
 
     def _build_context_from_instance(self, inst: str) -> Optional[Dict[str, str]]:
-        if inst not in self.meta.instances:
+        # the returned dict is shared by every record of this instance; don't mutate it
+        cached = self._ctx_cache.get(inst)
+        if cached is not None:
+            return cached
+        inst_obj = self.meta.instances.get(inst)
+        if inst_obj is None:
             return None
+        # keys and values repeat across many records: intern them so they are stored once
         ctx: Dict[str, str] = {}
-        inst_obj = self.meta.instances[inst]
-        cls = inst_obj.class_name
-        if cls:
-            ctx[f"@{cls}"] = inst
-        to_visit = list(inst_obj.parents)
+        if inst_obj.class_name:
+            ctx[sys.intern(f"@{inst_obj.class_name}")] = sys.intern(inst)
+        # BFS over the parents: the nearest ancestor of a class wins, ties go to parent-list order
+        to_visit: Deque[str] = deque(inst_obj.parents)
         seen: Set[str] = set()
         while to_visit:
-            p = to_visit.pop(0)
+            p = to_visit.popleft()
             if p in seen:
                 continue
             seen.add(p)
             pobj = self.meta.instances.get(p)
             if not pobj:
                 continue
-            if pobj.class_name and f"@{pobj.class_name}" not in ctx:
-                ctx[f"@{pobj.class_name}"] = p
+            if pobj.class_name:
+                ctx.setdefault(sys.intern(f"@{pobj.class_name}"), sys.intern(p))
             to_visit.extend(pobj.parents)
+        ctx = self._pooled(ctx)
+        self._ctx_cache[inst] = ctx
         return ctx
 
-    def _build_index(self) -> None:
-        for fname, ftemp in self.cfg.files.items():
-            dtemp = self.cfg.dirs.get(ftemp.dir_ref)
-            if not dtemp:
+    def _pooled(self, ctx: Dict[str, str]) -> Dict[str, str]:
+        return self._ctx_pool.setdefault(frozenset(ctx.items()), ctx)
+
+    def preload(self, keys: Optional[Iterable[str]] = None) -> None:
+        """Index the given file keys (all cfg file keys by default) ahead of any lookup."""
+        for fname in (self.cfg.files if keys is None else keys):
+            self._ensure_index(fname)
+
+    def _ensure_index(self, file_key: str) -> bool:
+        if file_key not in self._built:
+            if file_key not in self.cfg.files:
+                return False
+            self._build_index_for(file_key)
+        return file_key in self.index
+
+    def _build_index_for(self, fname: str) -> None:
+        self._built.add(fname)
+        ftemp = self.cfg.files[fname]
+        dtemp = self.cfg.dirs.get(ftemp.dir_ref)
+        if not dtemp:
+            return
+        lvl = sys.intern(ftemp.class_level) if ftemp.class_level else ftemp.class_level
+
+        # one walk over the instances yields both the meta overrides ("raw")
+        # and the class_level expansions ("out"); raw records are listed first
+        raw: List[Dict] = []
+        out: List[Dict] = []
+        if not lvl:
+            full_path = self._expand_file(ftemp, dtemp, {})
+            if full_path is not None:
+                out.append({
+                    "path": full_path,
+                    "placeholders": self._pooled({}),
+                    "class_level": lvl,
+                    "source": "out",
+                })
+        for inst_name, inst in self.meta.instances.items():
+            override = inst.props.get(fname)
+            at_level = bool(lvl) and inst.class_name == lvl
+            if override is None and not at_level:
                 continue
-
-            required_ph = self._ph_needed_for_file(ftemp, dtemp)
-            contexts = self._contexts_for_class_level(ftemp.class_level)
-
-            for inst_name, inst in self.meta.instances.items():
-                if fname in inst.props:
-                    path = _expand_dollars(inst.props[fname], {**self.varmap, **self.concrete_dirs})
-                    if not os.path.isabs(path):
-                        path = _norm_join(self.cwd, path)
-                    ctx = self._build_context_from_instance(inst_name) or {}
-                    self.index.setdefault(fname, []).append({
-                        "path": path,
+            ctx = self._build_context_from_instance(inst_name) or self._pooled({})
+            if override is not None:
+                path = _render(_segments(override), self._full_varmap)
+                if not os.path.isabs(path):
+                    path = _norm_join(self.cwd, path)
+                raw.append({
+                    "path": path,
+                    "placeholders": ctx,
+                    "class_level": lvl,
+                    "source": "raw",
+                })
+            if at_level:
+                full_path = self._expand_file(ftemp, dtemp, ctx)
+                if full_path is not None:
+                    out.append({
+                        "path": full_path,
                         "placeholders": ctx,
-                        "class_level": ftemp.class_level,
-                        "source": "raw",
+                        "class_level": lvl,
+                        "source": "out",
                     })
 
-            for base_ctx in contexts:
-                full_dir = self._resolve_dir(dtemp, base_ctx)
-                if full_dir is None:
-                    continue
-                fname_expanded = self._expand_placeholders(ftemp.tpl, base_ctx)
-                if '@' in fname_expanded:
-                    continue
-                full_path = _norm_join(full_dir, fname_expanded)
-                self.index.setdefault(fname, []).append({
-                    "path": full_path,
-                    "placeholders": dict(base_ctx),
-                    "class_level": ftemp.class_level,
-                    "source": "out",
-                })
+        for rec in raw + out:
+            self._add_record(fname, rec)
+
+    def _add_record(self, fname: str, rec: Dict) -> None:
+        recs = self.index.setdefault(fname, {}).setdefault(rec["source"], [])
+        postings = self.filter_index.setdefault(fname, {}).setdefault(rec["source"], {})
+        i = len(recs)
+        recs.append(rec)
+        for kv in rec["placeholders"].items():
+            postings.setdefault(kv, []).append(i)
+
+    def _matching(self, file_key: str, filters: Dict[str, str], source: Optional[str] = None) -> List[Dict]:
+        norm_items = tuple((_norm_key(k), v) for k, v in filters.items())
+        if source:
+            return self._match_bucket(file_key, source, norm_items)
+        return [rec for src in _SOURCES for rec in self._match_bucket(file_key, src, norm_items)]
+
+    def _match_bucket(self, file_key: str, source: str, norm_items: Tuple[Tuple[str, str], ...]) -> List[Dict]:
+        recs = self.index[file_key].get(source)
+        if not recs:
+            return []
+        if not norm_items:
+            return recs
+        postings = self.filter_index.get(file_key, {}).get(source)
+        if postings is None:
+            return [rec for rec in recs
+                    if all(rec["placeholders"].get(k) == v for k, v in norm_items)]
+        # the most selective filter picks the candidates; the others are checked on those
+        # records only, so the cost follows the smallest posting list, not the catalog
+        ids = min((postings.get(kv, []) for kv in norm_items), key=len)
+        if len(norm_items) == 1:
+            return [recs[i] for i in ids]
+        return [rec for rec in map(recs.__getitem__, ids)
+                if all(rec["placeholders"].get(k) == v for k, v in norm_items)]
 
     def get(self, file_key: str, source: Optional[str] = None, **filters: str) -> List[str]:
-        if file_key not in self.index:
+        if not self._ensure_index(file_key):
             return []
-        norm_filters = { (f"@{k}" if not k.startswith("@") else k): v for k, v in filters.items() }
-        out: List[str] = []
-        for rec in self.index[file_key]:
-            ctx = rec["placeholders"]
-            if all(ctx.get(k) == v for k, v in norm_filters.items()):
-                if source and rec["source"] != source:
-                    continue
-                out.append(rec["path"])
-        return out
+        return [rec["path"] for rec in self._matching(file_key, filters, source)]
 
     def records(self, file_key: str, **filters: str) -> List[Dict]:
-        if file_key not in self.index:
+        if not self._ensure_index(file_key):
             return []
-        norm_filters = { (f"@{k}" if not k.startswith("@") else k): v for k, v in filters.items() }
-        out: List[Dict] = []
-        for rec in self.index[file_key]:
-            ctx = rec["placeholders"]
-            if all(ctx.get(k) == v for k, v in norm_filters.items()):
-                out.append(rec)
-        return out
\ No newline at end of file
+        return list(self._matching(file_key, filters))
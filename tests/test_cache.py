@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from lap_notebook.resolver import LapResolver
+
+CFG = """\
+base_dir=/data
+class validation=Validation
+mkdir path val_dir=$base_dir/@validation class_level validation
+path file stats_file=@validation.stats.txt dir val_dir class_level validation
+"""
+
+META = """\
+v1 class validation
+v2 class validation
+"""
+
+
+class ResolverCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.cfg_path = os.path.join(self.dir, "p.cfg")
+        self.meta_path = os.path.join(self.dir, "p.meta")
+        self._write(self.cfg_path, CFG)
+        self._write(self.meta_path, META)
+
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.dir, "cache")})
+        env.start()
+        self.addCleanup(env.stop)
+        self.cache_dir = os.path.join(self.dir, "cache", "lap_notebook")
+
+        builds = mock.patch.object(LapResolver, "_build_from_files", wraps=LapResolver._build_from_files)
+        self.builds = builds.start()
+        self.addCleanup(builds.stop)
+
+    def _write(self, path, text):
+        with open(path, "w") as f:
+            f.write(text)
+
+    def _load(self, **kwargs):
+        return LapResolver.from_files(self.cfg_path, self.meta_path, cwd=self.dir, **kwargs)
+
+    def _entries(self):
+        return sorted(os.listdir(self.cache_dir)) if os.path.isdir(self.cache_dir) else []
+
+    def test_hit_skips_rebuild(self):
+        first = self._load()
+        second = self._load()
+        self.assertEqual(self.builds.call_count, 1)
+        self.assertEqual(second.get("stats_file"), first.get("stats_file"))
+        self.assertEqual(second.get("stats_file", validation="v2"), ["/data/v2/v2.stats.txt"])
+        self.assertEqual(len(self._entries()), 1)
+
+    def test_content_change_rebuilds(self):
+        self._load()
+        self._write(self.meta_path, META + "v3 class validation\n")
+        resolver = self._load()
+        self.assertEqual(self.builds.call_count, 2)
+        self.assertEqual(resolver.get("stats_file", validation="v3"), ["/data/v3/v3.stats.txt"])
+        self.assertEqual(len(self._entries()), 1)
+
+    def test_allow_stale_returns_old_copy_and_refreshes(self):
+        self._load()
+        self._write(self.meta_path, META + "v3 class validation\n")
+        stale = self._load(allow_stale=True)
+        self.assertEqual(stale.get("stats_file", validation="v3"), [])
+        for t in threading.enumerate():
+            if t is not threading.current_thread() and t.daemon:
+                t.join(10)
+        self.assertEqual(self.builds.call_count, 2)
+
+        fresh = self._load()
+        self.assertEqual(self.builds.call_count, 2)
+        self.assertEqual(fresh.get("stats_file", validation="v3"), ["/data/v3/v3.stats.txt"])
+
+    def test_use_cache_false_writes_nothing(self):
+        self._load(use_cache=False)
+        self._load(use_cache=False)
+        self.assertEqual(self.builds.call_count, 2)
+        self.assertEqual(self._entries(), [])
+
+    def test_clear_cache(self):
+        self._load()
+        orphan = os.path.join(self.cache_dir, "resolver-orphan.pkl.tmp")
+        self._write(orphan, "")
+        LapResolver.clear_cache()
+        self.assertEqual(self._entries(), [])
+        self._load()
+        self.assertEqual(self.builds.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()